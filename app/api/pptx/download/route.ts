@@ -1,13 +1,28 @@
 /**
  * PPTX Download Proxy API
  * PPTXサービスからファイルをプロキシダウンロード
+ * 条件付きGET（ETag / Last-Modified）とRangeリクエストをそのまま中継する
  */
 
 import { NextRequest, NextResponse } from 'next/server';
 
 const PPTX_SERVICE_URL = process.env.PPTX_SERVICE_URL || 'http://localhost:8100';
 
-export async function GET(request: NextRequest) {
+// サービスへ転送するリクエストヘッダー
+const FORWARDED_REQUEST_HEADERS = ['range', 'if-range', 'if-none-match', 'if-modified-since'];
+
+// クライアントへ返すレスポンスヘッダー
+const FORWARDED_RESPONSE_HEADERS = [
+  'content-type',
+  'content-length',
+  'content-range',
+  'content-disposition',
+  'accept-ranges',
+  'etag',
+  'last-modified',
+];
+
+async function proxyDownload(request: NextRequest, method: 'GET' | 'HEAD') {
   const { searchParams } = new URL(request.url);
   const filename = searchParams.get('filename');
 
@@ -18,23 +33,44 @@ export async function GET(request: NextRequest) {
     );
   }
 
+  const upstreamHeaders = new Headers();
+  for (const name of FORWARDED_REQUEST_HEADERS) {
+    const value = request.headers.get(name);
+    if (value) {
+      upstreamHeaders.set(name, value);
+    }
+  }
+
   try {
-    const response = await fetch(`${PPTX_SERVICE_URL}/download/${filename}`);
+    const response = await fetch(`${PPTX_SERVICE_URL}/download/${encodeURIComponent(filename)}`, {
+      method,
+      headers: upstreamHeaders,
+    });
 
-    if (!response.ok) {
+    if (response.status === 404) {
       return NextResponse.json(
         { error: 'File not found' },
         { status: 404 }
       );
     }
 
-    const buffer = await response.arrayBuffer();
+    const headers = new Headers();
+    for (const name of FORWARDED_RESPONSE_HEADERS) {
+      const value = response.headers.get(name);
+      if (value) {
+        headers.set(name, value);
+      }
+    }
+    if (!headers.has('content-disposition')) {
+      headers.set('Content-Disposition', `attachment; filename="${filename}"`);
+    }
+
+    // 304 / HEAD はボディなし、それ以外はストリームで中継
+    const body = method === 'HEAD' || response.status === 304 ? null : response.body;
 
-    return new NextResponse(buffer, {
-      headers: {
-        'Content-Type': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-        'Content-Disposition': `attachment; filename="${filename}"`,
-      },
+    return new NextResponse(body, {
+      status: response.status,
+      headers,
     });
   } catch (error: unknown) {
     const message = error instanceof Error ? error.message : 'Unknown error';
@@ -44,3 +80,11 @@ export async function GET(request: NextRequest) {
     );
   }
 }
+
+export async function GET(request: NextRequest) {
+  return proxyDownload(request, 'GET');
+}
+
+export async function HEAD(request: NextRequest) {
+  return proxyDownload(request, 'HEAD');
+}
@@ -20,10 +20,11 @@ interface SlideContent {
 }
 
 interface GenerateRequest {
-  action: 'list_templates' | 'analyze_template' | 'generate' | 'fill_template' | 'status';
+  action: 'list_templates' | 'analyze_template' | 'generate' | 'validate' | 'fill_template' | 'status';
   template_id?: string;
   slides?: SlideContent[];
   output_filename?: string;
+  auto_fit?: boolean;
   metadata?: {
     author?: string;
     title?: string;
@@ -93,7 +94,7 @@ export async function GET(request: NextRequest) {
 export async function POST(request: NextRequest) {
   try {
     const body: GenerateRequest = await request.json();
-    const { action, template_id, slides, output_filename, metadata } = body;
+    const { action, template_id, slides, output_filename, metadata, auto_fit } = body;
 
     switch (action) {
       case 'generate': {
@@ -111,7 +112,8 @@ export async function POST(request: NextRequest) {
             template_id,
             slides,
             output_filename,
-            metadata
+            metadata,
+            auto_fit
           })
         });
 
@@ -129,6 +131,27 @@ export async function POST(request: NextRequest) {
         return NextResponse.json(data);
       }
 
+      case 'validate': {
+        if (!slides || slides.length === 0) {
+          return NextResponse.json(
+            { error: 'slides array is required' },
+            { status: 400 }
+          );
+        }
+
+        const response = await fetch(`${PPTX_SERVICE_URL}/generate/validate`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({
+            template_id,
+            slides
+          })
+        });
+
+        const data = await response.json();
+        return NextResponse.json(data, { status: response.status });
+      }
+
       case 'fill_template': {
         if (!template_id) {
           return NextResponse.json(
@@ -68,24 +68,27 @@ class PPTXGenerator_Tools implements INode {
 使用方法:
 1. action: "list_templates" - 利用可能なテンプレート一覧を取得
 2. action: "analyze_template" - テンプレートの構造を解析
-3. action: "generate" - 新規プレゼンテーションを生成
-4. action: "fill_template" - 既存テンプレートにコンテンツを埋め込む
+3. action: "validate" - 生成せずにスライド内容をテンプレートと照合（generate前の確認用）
+4. action: "generate" - 新規プレゼンテーションを生成
+5. action: "fill_template" - 既存テンプレートにコンテンツを埋め込む
 
 スライドを作成するには、slidesに各スライドの内容を配列で指定します。
 各スライドには title, subtitle, body, bullets（箇条書き）, notes（発表者ノート）を設定できます。`,
 
             schema: z.object({
-                action: z.enum(['list_templates', 'analyze_template', 'generate', 'fill_template'])
+                action: z.enum(['list_templates', 'analyze_template', 'validate', 'generate', 'fill_template'])
                     .describe('実行するアクション'),
                 template_id: z.string().optional()
                     .describe('使用するテンプレートID'),
                 slides: z.array(slideSchema).optional()
                     .describe('スライドコンテンツの配列'),
                 output_filename: z.string().optional()
-                    .describe('出力ファイル名')
+                    .describe('出力ファイル名'),
+                auto_fit: z.boolean().optional()
+                    .describe('はみ出すテキストのフォントを縮小し、収まらなければ続きのスライドに分割する')
             }),
 
-            func: async ({ action, template_id, slides, output_filename }) => {
+            func: async ({ action, template_id, slides, output_filename, auto_fit }) => {
                 const templateId = template_id || defaultTemplateId
 
                 try {
@@ -105,6 +108,22 @@ class PPTXGenerator_Tools implements INode {
                             return JSON.stringify(data, null, 2)
                         }
 
+                        case 'validate': {
+                            if (!slides || slides.length === 0) {
+                                return 'Error: slides array is required for validate action'
+                            }
+                            const response = await fetch(`${serviceUrl}/generate/validate`, {
+                                method: 'POST',
+                                headers: { 'Content-Type': 'application/json' },
+                                body: JSON.stringify({
+                                    template_id: templateId,
+                                    slides
+                                })
+                            })
+                            const data = await response.json()
+                            return JSON.stringify(data, null, 2)
+                        }
+
                         case 'generate': {
                             if (!slides || slides.length === 0) {
                                 return 'Error: slides array is required for generate action'
@@ -115,7 +134,8 @@ class PPTXGenerator_Tools implements INode {
                                 body: JSON.stringify({
                                     template_id: templateId,
                                     slides,
-                                    output_filename
+                                    output_filename,
+                                    auto_fit
                                 })
                             })
                             const data = await response.json()
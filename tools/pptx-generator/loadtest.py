@@ -0,0 +1,557 @@
+"""
+PPTX Generator Service 負荷テストハーネス
+ローカルでサービスを起動し、Flowiseツール / Next.js API と同じ形のリクエスト
+（list / analyze / generate / fill / download）を指定した並列度で同時に流す
+
+使い方:
+    python loadtest.py loadtest_profiles/pptx-generator-agent.json
+    python loadtest.py --agent ../../data/owlagents/pptx-generator-agent.json -c 1 8 32
+    python loadtest.py flowise-tool-mixed --url http://localhost:8100 --pid 12345
+"""
+
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Any, Tuple
+from pathlib import Path
+
+
+# ===== 設定 =====
+BASE_DIR = Path(__file__).parent
+PROFILES_DIR = BASE_DIR / "loadtest_profiles"
+# ローカル起動したサービスのテンプレート置き場（pptx_service.py と同じ）
+TEMPLATES_DIR = BASE_DIR / "templates"
+TEMPLATE_VERSIONS_DIR = TEMPLATES_DIR / ".versions"
+
+LOADTEST_TEMPLATE_ID = "loadtest-template"
+ENDPOINTS = ["list_templates", "analyze_template", "generate", "fill_template", "download"]
+RSS_SAMPLE_INTERVAL = 0.5
+REQUEST_TIMEOUT = 120
+
+DEFAULT_SLIDES = [
+    {"layout_index": 0, "title": "負荷テスト", "subtitle": "PPTX Generator Service"},
+    {"layout_index": 1, "title": "概要", "bullets": ["ポイント1", "ポイント2", "ポイント3"]},
+]
+
+# エージェントのツールノード（apiEndpoint）とエンドポイントの対応
+AGENT_ENDPOINT_KEYWORDS = {
+    "analyze": "analyze_template",
+    "generate": "generate",
+    "fill": "fill_template",
+    "templates": "list_templates",
+    "download": "download",
+}
+
+
+# ===== プロファイル =====
+
+def load_profile(path: Path) -> Dict[str, Any]:
+    """ワークロードプロファイルを読み込む"""
+    with open(path, encoding="utf-8") as f:
+        profile = json.load(f)
+    unknown = set(profile.get("mix", {})) - set(ENDPOINTS)
+    if unknown:
+        raise ValueError(f"Unknown endpoints in mix: {sorted(unknown)}")
+    return profile
+
+
+def extract_example_slides(agent: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """LLMノードのシステムメッセージに含まれるJSON例を抽出"""
+    for node in agent.get("flow", {}).get("nodes", []):
+        system_message = node.get("data", {}).get("config", {}).get("systemMessage", "")
+        match = re.search(r"```json([\s\S]*?)```", system_message)
+        if not match:
+            continue
+        try:
+            example = json.loads(match.group(1).strip())
+        except json.JSONDecodeError:
+            continue
+        if isinstance(example, dict) and example.get("slides"):
+            return example
+    return None
+
+
+def build_profile_from_agent(agent: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    OwlAgent定義からワークロードプロファイルを生成
+    ツールノードのapiEndpointを呼び出し比率に、LLMノードの出力例をスライド内容に使う
+    """
+    mix: Dict[str, float] = {}
+    for node in agent.get("flow", {}).get("nodes", []):
+        config = node.get("data", {}).get("config", {})
+        endpoint = config.get("apiEndpoint")
+        if endpoint:
+            last_segment = endpoint.rstrip("/").rsplit("/", 1)[-1]
+            for keyword, name in AGENT_ENDPOINT_KEYWORDS.items():
+                if keyword in last_segment:
+                    mix[name] = mix.get(name, 0) + 1
+                    break
+        # 完了ノードがダウンロードURLを返す場合はダウンロードも発生する
+        if "download_url" in config.get("responseTemplate", ""):
+            mix["download"] = mix.get("download", 0) + 1
+
+    if not mix:
+        raise ValueError(f"Agent {agent.get('id')} has no PPTX service calls")
+
+    example = extract_example_slides(agent) or {}
+    return {
+        "name": agent.get("id", "agent"),
+        "description": f"Derived from OwlAgent: {agent.get('name', agent.get('id'))}",
+        "source_agent": agent.get("id"),
+        "template_id": agent.get("settings", {}).get("defaultTemplateId"),
+        "mix": mix,
+        "slides": example.get("slides", DEFAULT_SLIDES),
+        "metadata": example.get("metadata"),
+    }
+
+
+# ===== HTTPクライアント =====
+
+def http_request(
+    url: str,
+    method: str = "GET",
+    payload: Optional[Dict[str, Any]] = None,
+    body: Optional[bytes] = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> Tuple[int, bytes]:
+    """HTTPリクエストを送信して (ステータス, ボディ) を返す"""
+    headers = dict(headers or {})
+    if payload is not None:
+        body = json.dumps(payload).encode("utf-8")
+        headers["Content-Type"] = "application/json"
+    req = urllib.request.Request(url, data=body, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as resp:
+            return resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def upload_template(base_url: str, template_id: str, content: bytes) -> str:
+    """テンプレートをmultipartでアップロードし、バージョン（内容ハッシュ）を返す"""
+    boundary = uuid.uuid4().hex
+    parts = [
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="template_id"\r\n\r\n'
+        f"{template_id}\r\n".encode("utf-8"),
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{template_id}.pptx"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n".encode("utf-8"),
+        content,
+        f"\r\n--{boundary}--\r\n".encode("utf-8"),
+    ]
+    status, body = http_request(
+        f"{base_url}/templates/upload",
+        method="POST",
+        body=b"".join(parts),
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+    )
+    if status != 200:
+        raise RuntimeError(f"Template upload failed ({status}): {body[:200]!r}")
+    return json.loads(body)["version"]
+
+
+# ===== サービス起動 =====
+
+def start_service(port: int) -> subprocess.Popen:
+    """サービスをローカルで起動し、ヘルスチェックが通るまで待つ"""
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "pptx_service:app",
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=str(BASE_DIR),
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Service exited with code {proc.returncode}")
+        try:
+            if http_request(f"{base_url}/")[0] == 200:
+                return proc
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("Service did not become healthy within 30 seconds")
+
+
+def read_rss_mb(pid: int) -> Optional[float]:
+    """プロセスのRSS（MB）を取得（/proc が無い環境では None）"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class RSSSampler(threading.Thread):
+    """サーバープロセスのRSSを一定間隔で記録"""
+
+    def __init__(self, pid: int, interval: float = RSS_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[Tuple[float, float]] = []
+        self._stop_event = threading.Event()
+        self._started_at = time.monotonic()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            rss = read_rss_mb(self.pid)
+            if rss is not None:
+                self.samples.append((round(time.monotonic() - self._started_at, 2), round(rss, 1)))
+            self._stop_event.wait(self.interval)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+# ===== ワークロード =====
+
+@dataclass
+class Result:
+    endpoint: str
+    latency: float
+    ok: bool
+
+
+@dataclass
+class Workload:
+    """プロファイルに従ってリクエストを生成・送信する"""
+    base_url: str
+    profile: Dict[str, Any]
+    template_id: str
+    seed: int = 0
+    generated_files: List[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        mix = self.profile["mix"]
+        self._endpoints = [name for name in ENDPOINTS if mix.get(name, 0) > 0]
+        self._weights = [mix[name] for name in self._endpoints]
+
+    def worker_rng(self, concurrency: int, worker_index: int) -> random.Random:
+        """ワーカーごとの乱数（シード・並列度・ワーカー番号から決まるので実行ごとに再現できる）"""
+        return random.Random(f"{self.seed}-{concurrency}-{worker_index}")
+
+    def _remember(self, body: bytes) -> None:
+        filename = json.loads(body).get("filename")
+        if filename:
+            with self._lock:
+                self.generated_files.append(filename)
+
+    def _pick_file(self, rng: random.Random) -> Optional[str]:
+        with self._lock:
+            if not self.generated_files:
+                return None
+            return rng.choice(self.generated_files)
+
+    def call(self, endpoint: str, rng: random.Random) -> Tuple[str, int]:
+        """1リクエストを送信して (実際に呼び出したエンドポイント, ステータス) を返す"""
+        slides = self.profile.get("slides", DEFAULT_SLIDES)
+
+        if endpoint == "list_templates":
+            return endpoint, http_request(f"{self.base_url}/templates")[0]
+
+        if endpoint == "analyze_template":
+            return endpoint, http_request(f"{self.base_url}/templates/{self.template_id}/analyze")[0]
+
+        if endpoint == "generate":
+            status, body = http_request(f"{self.base_url}/generate", method="POST", payload={
+                "template_id": self.template_id,
+                "slides": slides,
+                "metadata": self.profile.get("metadata"),
+            })
+            if status == 200:
+                self._remember(body)
+            return endpoint, status
+
+        if endpoint == "fill_template":
+            status, body = http_request(
+                f"{self.base_url}/templates/{self.template_id}/fill",
+                method="POST",
+                payload={"slides": slides},
+            )
+            if status == 200:
+                self._remember(body)
+            return endpoint, status
+
+        if endpoint == "download":
+            filename = self._pick_file(rng)
+            if filename is None:
+                # ダウンロード対象がまだ無い間は生成を行い、生成として集計する
+                return self.call("generate", rng)
+            return endpoint, http_request(f"{self.base_url}/download/{filename}")[0]
+
+        raise ValueError(f"Unknown endpoint: {endpoint}")
+
+    def run_one(self, rng: random.Random) -> Result:
+        endpoint = rng.choices(self._endpoints, weights=self._weights)[0]
+        started = time.perf_counter()
+        try:
+            endpoint, status = self.call(endpoint, rng)
+            ok = 200 <= status < 400
+        except (OSError, ValueError):
+            ok = False
+        return Result(endpoint, time.perf_counter() - started, ok)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """最近傍法によるパーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(results: List[Result], elapsed: float) -> Dict[str, Any]:
+    """エンドポイント別にスループット・レイテンシ・エラー率を集計"""
+    by_endpoint: Dict[str, List[Result]] = {}
+    for result in results:
+        by_endpoint.setdefault(result.endpoint, []).append(result)
+
+    endpoints = {}
+    for name in ENDPOINTS:
+        group = by_endpoint.get(name)
+        if not group:
+            continue
+        latencies = sorted(r.latency * 1000 for r in group)
+        errors = sum(1 for r in group if not r.ok)
+        endpoints[name] = {
+            "requests": len(group),
+            "errors": errors,
+            "error_rate": errors / len(group),
+            "throughput": len(group) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+        }
+
+    errors = sum(1 for r in results if not r.ok)
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "error_rate": errors / len(results) if results else 0.0,
+        "elapsed_s": elapsed,
+        "throughput": len(results) / elapsed if elapsed else 0.0,
+        "endpoints": endpoints,
+    }
+
+
+def run_level(
+    workload: Workload,
+    concurrency: int,
+    requests: Optional[int],
+    duration: Optional[float],
+) -> Dict[str, Any]:
+    """指定した並列度でワークロードを実行"""
+    results: List[Result] = []
+    lock = threading.Lock()
+    remaining = [requests]
+    deadline = time.monotonic() + duration if duration else None
+
+    def take() -> bool:
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        if remaining[0] is None:
+            return True
+        with lock:
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+            return True
+
+    def worker(worker_index: int) -> None:
+        rng = workload.worker_rng(concurrency, worker_index)
+        while take():
+            result = workload.run_one(rng)
+            with lock:
+                results.append(result)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for worker_index in range(concurrency):
+            pool.submit(worker, worker_index)
+    return summarize(results, time.perf_counter() - started)
+
+
+def bootstrap_template(
+    base_url: str,
+    template_id: Optional[str],
+    slides: List[Dict[str, Any]],
+    local_service: bool
+) -> Tuple[str, Optional[str]]:
+    """
+    テスト用テンプレートを用意し、(テンプレートID, アップロードしたバージョン) を返す
+    指定テンプレートが存在しなければ、サービスで生成したデッキをアップロードして使う
+    アップロードしたテンプレートは終了時にファイルを直接削除するため、ローカル起動時のみ行う
+    """
+    if template_id:
+        status, _ = http_request(f"{base_url}/templates/{template_id}/analyze")
+        if status == 200:
+            return template_id, None
+    if not local_service:
+        raise RuntimeError(
+            f"Template {template_id!r} not found on {base_url}; upload it first, "
+            f"or run without --url to use a temporary template"
+        )
+
+    status, body = http_request(f"{base_url}/generate", method="POST", payload={
+        "slides": slides,
+        "output_filename": f"{LOADTEST_TEMPLATE_ID}-seed.pptx",
+    })
+    if status != 200:
+        raise RuntimeError(f"Failed to generate seed deck ({status}): {body[:200]!r}")
+    filename = json.loads(body)["filename"]
+    status, content = http_request(f"{base_url}/download/{filename}")
+    if status != 200:
+        raise RuntimeError(f"Failed to download seed deck ({status})")
+    http_request(f"{base_url}/files/{filename}", method="DELETE")
+    version = upload_template(base_url, LOADTEST_TEMPLATE_ID, content)
+    return LOADTEST_TEMPLATE_ID, version
+
+
+def remove_local_template(template_id: str, version: str) -> None:
+    """ローカル起動したサービスのテンプレートとそのバージョンを削除（サービス停止後に呼ぶ）"""
+    (TEMPLATES_DIR / f"{template_id}.pptx").unlink(missing_ok=True)
+    (TEMPLATE_VERSIONS_DIR / f"{version}.pptx").unlink(missing_ok=True)
+
+
+# ===== レポート =====
+
+def format_report(profile_name: str, levels: List[Dict[str, Any]]) -> str:
+    """結果を表形式の文字列にする"""
+    lines = [f"Profile: {profile_name}"]
+    for level in levels:
+        summary = level["summary"]
+        rss = level["rss_mb"]
+        rss_text = (
+            f"rss start={rss[0][1]:.1f}MB peak={max(s[1] for s in rss):.1f}MB end={rss[-1][1]:.1f}MB"
+            if rss else "rss n/a"
+        )
+        lines.append("")
+        lines.append(
+            f"concurrency={level['concurrency']}  requests={summary['requests']}  "
+            f"throughput={summary['throughput']:.1f} req/s  "
+            f"errors={summary['error_rate']:.1%}  {rss_text}"
+        )
+        lines.append(
+            f"  {'endpoint':<18}{'reqs':>7}{'req/s':>9}{'err%':>8}"
+            f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        )
+        for name, stats in summary["endpoints"].items():
+            lines.append(
+                f"  {name:<18}{stats['requests']:>7}{stats['throughput']:>9.1f}"
+                f"{stats['error_rate'] * 100:>8.1f}{stats['p50_ms']:>10.1f}"
+                f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+            )
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="PPTX Generator Service load test")
+    parser.add_argument("profile", nargs="?", type=Path, help="ワークロードプロファイル（JSON）")
+    parser.add_argument("--agent", type=Path, help="OwlAgent定義からプロファイルを生成")
+    parser.add_argument("--url", help="既存サービスのURL（省略時はローカルで起動）")
+    parser.add_argument("--port", type=int, default=8199, help="ローカル起動時のポート")
+    parser.add_argument("--pid", type=int, help="--url 使用時にRSSを計測するサーバーPID")
+    parser.add_argument("-c", "--concurrency", type=int, nargs="+", help="並列度（複数指定可）")
+    parser.add_argument("-n", "--requests", type=int, help="並列度ごとのリクエスト数")
+    parser.add_argument("-d", "--duration", type=float, help="並列度ごとの実行秒数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+    parser.add_argument("--json-out", type=Path, help="結果（RSS推移を含む）をJSONで保存")
+    parser.add_argument("--keep-files", action="store_true", help="生成ファイルを削除しない")
+    args = parser.parse_args(argv)
+    if (args.profile is None) == (args.agent is None):
+        parser.error("specify exactly one of PROFILE or --agent")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.agent:
+        with open(args.agent, encoding="utf-8") as f:
+            profile = build_profile_from_agent(json.load(f))
+    else:
+        profile_path = args.profile
+        if not profile_path.exists():
+            # プロファイル名のみ指定された場合は同梱プロファイルを探す
+            profile_path = PROFILES_DIR / f"{args.profile.stem}.json"
+        profile = load_profile(profile_path)
+
+    concurrency_levels = args.concurrency or profile.get("concurrency", [1, 4, 16])
+    requests = args.requests or profile.get("requests_per_level")
+    duration = args.duration or profile.get("duration_seconds")
+    if requests is None and duration is None:
+        requests = 100
+
+    proc = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+        server_pid = args.pid
+    else:
+        proc = start_service(args.port)
+        base_url = f"http://127.0.0.1:{args.port}"
+        server_pid = proc.pid
+
+    workload = None
+    template_id = None
+    uploaded_version = None
+    try:
+        template_id, uploaded_version = bootstrap_template(
+            base_url, profile.get("template_id"), profile.get("slides", DEFAULT_SLIDES), proc is not None
+        )
+        workload = Workload(base_url, profile, template_id, seed=args.seed)
+
+        levels = []
+        for concurrency in concurrency_levels:
+            sampler = RSSSampler(server_pid) if server_pid else None
+            if sampler:
+                sampler.start()
+            summary = run_level(workload, concurrency, requests, duration)
+            if sampler:
+                sampler.stop()
+            levels.append({
+                "concurrency": concurrency,
+                "summary": summary,
+                "rss_mb": sampler.samples if sampler else [],
+            })
+
+        print(format_report(profile.get("name", "profile"), levels))
+        if args.json_out:
+            with open(args.json_out, "w", encoding="utf-8") as f:
+                json.dump({"profile": profile, "levels": levels}, f, ensure_ascii=False, indent=2)
+    finally:
+        if workload and not args.keep_files:
+            for filename in set(workload.generated_files):
+                try:
+                    http_request(f"{base_url}/files/{filename}", method="DELETE")
+                except OSError:
+                    pass
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=10)
+        # ハーネスがアップロードしたテンプレートは --keep-files に関わらず削除する
+        if uploaded_version:
+            remove_local_template(template_id, uploaded_version)
+
+    failed = any(level["summary"]["errors"] for level in levels)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,23 +3,46 @@ PowerPoint Generation Service for Flowise Integration
 python-pptx を使用してテンプレートベースのスライド生成を行う
 """
 
+import io
 import os
+import re
+import csv
+import copy
 import json
+import zipfile
 import uuid
 import shutil
+import tempfile
+import hashlib
+import threading
+import multiprocessing
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from functools import lru_cache, partial
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+from typing import Optional, List, Dict, Any, Tuple, Iterator, Iterable, Callable, BinaryIO
 from pathlib import Path
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
-from fastapi.responses import FileResponse
+import anyio
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from pptx import Presentation
 from pptx.util import Inches, Pt
 from pptx.dml.color import RgbColor
 from pptx.enum.text import PP_ALIGN, MSO_ANCHOR
-from pptx.enum.shapes import MSO_SHAPE_TYPE
+from pptx.enum.shapes import MSO_SHAPE_TYPE, PP_PLACEHOLDER
+from pptx.opc.constants import RELATIONSHIP_TYPE as RT
+from pptx.oxml import parse_xml
+from lxml import etree
+
+from text_fit import fit_paragraphs, metrics_available, BULLET_INDENT_PT, MIN_FONT_SIZE
 
 
 # ===== 設定 =====
@@ -27,11 +50,39 @@ BASE_DIR = Path(__file__).parent
 TEMPLATES_DIR = BASE_DIR / "templates"
 OUTPUT_DIR = BASE_DIR / "output"
 TEMP_DIR = BASE_DIR / "temp"
+# 内容ハッシュをファイル名とする不変のテンプレートバージョン置き場
+TEMPLATE_VERSIONS_DIR = TEMPLATES_DIR / ".versions"
+
+PPTX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+# 内容ハッシュキャッシュの上限（ファイル数）
+CONTENT_HASH_CACHE_SIZE = 4096
+# 最後に使われてからこの秒数が経つまでは古いテンプレートバージョンを削除しない
+# （同じディレクトリを共有する別プロセスが使用中の可能性があるため）
+TEMPLATE_VERSION_GRACE_SECONDS = 3600
+
+# オートフィット時の最大フォントサイズはテンプレートから継承されるサイズ（これで収まる場合は書式をそのまま使う）
+# テンプレートからサイズを取得できない場合のみ以下を使う
+AUTO_FIT_DEFAULT_FONT_SIZES = {"title": 40, "subtitle": 28, "body": 24, "bullets": 24}
+# 分割したスライドのタイトルに付ける接尾辞
+CONTINUATION_TITLE_SUFFIX = "（続き）"
+
+# メールマージ：全リクエストで共有するワーカープロセス数（1以下ならリクエスト処理スレッド内で逐次処理）
+MERGE_WORKERS = int(os.environ.get("PPTX_MERGE_WORKERS", os.cpu_count() or 1))
+# ワーカーごとに保持する解析済みテンプレートの数
+MERGE_TEMPLATE_CACHE_SIZE = 8
+# ワーカー1つあたりの処理中レコード数の上限（メモリ使用量をレコード数に依存させない）
+MERGE_IN_FLIGHT_PER_WORKER = 2
+# 1つのデッキにまとめる場合のレコード数上限（デッキ自体がレコード数に比例して大きくなるため）
+MERGE_MAX_COMBINED_RECORDS = 1000
+MERGE_RECORD_FORMATS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
 
 # ディレクトリ作成
 TEMPLATES_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 TEMP_DIR.mkdir(exist_ok=True)
+TEMPLATE_VERSIONS_DIR.mkdir(exist_ok=True)
 
 
 # ===== Pydantic Models =====
@@ -57,6 +108,10 @@ class PresentationRequest(BaseModel):
     slides: List[SlideContent] = Field(..., description="スライドコンテンツのリスト")
     output_filename: Optional[str] = Field(default=None, description="出力ファイル名")
     metadata: Optional[Dict[str, str]] = Field(default=None, description="メタデータ（作成者など）")
+    auto_fit: bool = Field(
+        default=False,
+        description="テキストがプレースホルダーからはみ出す場合にフォントを縮小し、収まらなければ続きのスライドに分割"
+    )
 
 
 class TemplateInfo(BaseModel):
@@ -67,6 +122,7 @@ class TemplateInfo(BaseModel):
     layouts: List[Dict[str, Any]]
     created_at: str
     file_path: str
+    version: Optional[str] = None
 
 
 class SlideAnalysis(BaseModel):
@@ -83,6 +139,31 @@ class TemplateAnalysis(BaseModel):
     slide_masters: List[Dict[str, Any]]
     layouts: List[Dict[str, Any]]
     slides: List[SlideAnalysis]
+    version: Optional[str] = None
+
+
+class SlideDiagnostic(BaseModel):
+    """スライドの検証メッセージ"""
+    level: str = Field(..., description="error（生成結果が意図と異なる）または warning")
+    field: str
+    message: str
+
+
+class SlideValidation(BaseModel):
+    """スライドごとの検証結果"""
+    slide_index: int
+    layout_index: int
+    layout_name: Optional[str]
+    diagnostics: List[SlideDiagnostic]
+
+
+class ValidationResult(BaseModel):
+    """プレゼンテーション生成リクエストの検証結果"""
+    valid: bool
+    template_version: Optional[str]
+    error_count: int
+    warning_count: int
+    slides: List[SlideValidation]
 
 
 # ===== FastAPI App =====
@@ -125,6 +206,28 @@ def analyze_placeholder(placeholder) -> Dict[str, Any]:
     }
 
 
+_TITLE_PLACEHOLDER_TYPES = (PP_PLACEHOLDER.TITLE, PP_PLACEHOLDER.CENTER_TITLE, PP_PLACEHOLDER.VERTICAL_TITLE)
+
+
+def placeholder_font_size(placeholder) -> Optional[float]:
+    """
+    レイアウトのプレースホルダーに継承されるフォントサイズ（pt、第1レベル）
+    レイアウトの lstStyle → マスターの同種プレースホルダーの lstStyle → マスターの titleStyle / bodyStyle の順に探す
+    """
+    sizes = placeholder._element.xpath("./p:txBody/a:lstStyle/a:lvl1pPr/a:defRPr/@sz")
+    base = placeholder._base_placeholder
+    if not sizes and base is not None:
+        sizes = base._element.xpath("./p:txBody/a:lstStyle/a:lvl1pPr/a:defRPr/@sz")
+    if not sizes:
+        is_title = placeholder.placeholder_format.type in _TITLE_PLACEHOLDER_TYPES
+        style = "titleStyle" if is_title else "bodyStyle"
+        sizes = placeholder.part.slide_master._element.xpath(
+            f"./p:txStyles/p:{style}/a:lvl1pPr/a:defRPr/@sz"
+        )
+    # sz は 1/100 pt 単位
+    return int(sizes[0]) / 100 if sizes else None
+
+
 def analyze_shape(shape) -> Dict[str, Any]:
     """シェイプを解析"""
     info = {
@@ -138,21 +241,23 @@ def analyze_shape(shape) -> Dict[str, Any]:
 
 
 def set_text_in_placeholder(placeholder, text: str, font_size: Optional[int] = None):
-    """プレースホルダーにテキストを設定"""
+    """プレースホルダーにテキストを設定（改行ごとに段落を分け、オートフィットの計測と一致させる）"""
     if placeholder.has_text_frame:
         tf = placeholder.text_frame
-        # 既存のテキストをクリア
-        for paragraph in tf.paragraphs:
-            paragraph.clear()
+        # 既存のテキストをクリア（先頭の段落の書式は残す）
+        for paragraph in tf.paragraphs[1:]:
+            paragraph._p.getparent().remove(paragraph._p)
+        tf.paragraphs[0].clear()
         # 新しいテキストを設定
-        p = tf.paragraphs[0]
-        run = p.add_run()
-        run.text = text
-        if font_size:
-            run.font.size = Pt(font_size)
+        for i, line in enumerate(text.split("\n")):
+            p = tf.paragraphs[0] if i == 0 else tf.add_paragraph()
+            run = p.add_run()
+            run.text = line
+            if font_size:
+                run.font.size = Pt(font_size)
 
 
-def add_bullets_to_placeholder(placeholder, bullets: List[str]):
+def add_bullets_to_placeholder(placeholder, bullets: List[str], font_size: Optional[int] = None):
     """プレースホルダーに箇条書きを追加"""
     if placeholder.has_text_frame:
         tf = placeholder.text_frame
@@ -164,6 +269,991 @@ def add_bullets_to_placeholder(placeholder, bullets: List[str]):
                 p = tf.add_paragraph()
             p.text = bullet
             p.level = 0
+            if font_size:
+                for run in p.runs:
+                    run.font.size = Pt(font_size)
+
+
+def fill_slides(slides, slides_content: List[Dict[str, Any]]):
+    """既存スライドの構造を保持したまま、プレースホルダーのテキストを置換"""
+    for slide, slide_data in zip(slides, slides_content):
+        for shape in slide.shapes:
+            if shape.is_placeholder:
+                ph_idx = shape.placeholder_format.idx
+
+                # タイトル（通常idx=0）
+                if ph_idx == 0 and "title" in slide_data:
+                    set_text_in_placeholder(shape, slide_data["title"])
+
+                # サブタイトル/本文（通常idx=1以上）
+                elif ph_idx == 1 and "subtitle" in slide_data:
+                    set_text_in_placeholder(shape, slide_data["subtitle"])
+
+                # カスタムマッピング
+                elif "placeholders" in slide_data:
+                    ph_key = str(ph_idx)
+                    if ph_key in slide_data["placeholders"]:
+                        set_text_in_placeholder(shape, slide_data["placeholders"][ph_key])
+
+        # ノート
+        if "notes" in slide_data:
+            notes_slide = slide.notes_slide
+            notes_slide.notes_text_frame.text = slide_data["notes"]
+
+
+def remove_leading_slides(prs, count: int):
+    """先頭から count 枚のスライドを削除"""
+    for _ in range(count):
+        rId = prs.slides._sldIdLst[0].rId
+        prs.part.drop_rel(rId)
+        del prs.slides._sldIdLst[0]
+
+
+# ===== コンテンツハッシュ / テンプレートバージョン =====
+
+# ファイルパス -> (st_ino, st_mtime_ns, st_size, sha256)（LRU、CONTENT_HASH_CACHE_SIZE 件まで）
+_content_hash_cache: "OrderedDict[str, Tuple[int, int, int, str]]" = OrderedDict()
+_content_hash_lock = threading.Lock()
+# 使用中のテンプレートバージョン -> 参照数
+_template_version_refs: Dict[str, int] = {}
+_template_version_lock = threading.Lock()
+
+
+def _stat_key(stat_result: os.stat_result) -> Tuple[int, int, int]:
+    return stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size
+
+
+def remember_content_hash(file_path: Path, stat_result: os.stat_result, content_hash: str):
+    """書き込み時に分かっている内容ハッシュを登録（rename では inode/mtime が変わらないので置換前の stat でよい）"""
+    with _content_hash_lock:
+        _content_hash_cache[str(file_path)] = (*_stat_key(stat_result), content_hash)
+        _content_hash_cache.move_to_end(str(file_path))
+        while len(_content_hash_cache) > CONTENT_HASH_CACHE_SIZE:
+            _content_hash_cache.popitem(last=False)
+
+
+def forget_content_hash(file_path: Path):
+    """削除したファイルのキャッシュを破棄"""
+    with _content_hash_lock:
+        _content_hash_cache.pop(str(file_path), None)
+
+
+def _cached_content_hash(file_path: Path, stat_result: os.stat_result) -> Optional[str]:
+    with _content_hash_lock:
+        cached = _content_hash_cache.get(str(file_path))
+        if cached and cached[:3] == _stat_key(stat_result):
+            _content_hash_cache.move_to_end(str(file_path))
+            return cached[3]
+    return None
+
+
+def open_file_content_hash(f: BinaryIO, file_path: Path) -> Tuple[str, os.stat_result]:
+    """
+    開いているファイルの内容のSHA-256と stat を返す
+    ハッシュと stat を同じファイルディスクリプタから取り、差し替え中でも整合させる
+    同じファイルが差し替えられていない限り（inode/mtime/サイズが同じ）キャッシュを利用
+    """
+    stat_result = os.fstat(f.fileno())
+    cached = _cached_content_hash(file_path, stat_result)
+    if cached:
+        return cached, stat_result
+
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    content_hash = digest.hexdigest()
+    remember_content_hash(file_path, stat_result, content_hash)
+    return content_hash, stat_result
+
+
+def file_content_hash(file_path: Path) -> Tuple[str, os.stat_result]:
+    """ファイル内容のSHA-256と stat を返す"""
+    with open(file_path, "rb") as f:
+        return open_file_content_hash(f, file_path)
+
+
+def template_version_path(content_hash: str) -> Path:
+    """テンプレートバージョンのパス（内容ハッシュで一意）"""
+    return TEMPLATE_VERSIONS_DIR / f"{content_hash}.pptx"
+
+
+def _copy_with_hash(src_path: Path, dst_path: Path) -> str:
+    """ファイルをコピーしながら内容ハッシュを計算"""
+    digest = hashlib.sha256()
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            dst.write(chunk)
+    return digest.hexdigest()
+
+
+def resolve_template_version(template_id: str) -> str:
+    """
+    テンプレートIDを最新バージョンの内容ハッシュに解決
+    手動で配置されたテンプレートは初回アクセス時にバージョン置き場へ取り込む
+    """
+    template_path = get_template_path(template_id)
+    content_hash, _ = file_content_hash(template_path)
+    if template_version_path(content_hash).exists():
+        return content_hash
+
+    # ハッシュ計算後に差し替えられても壊れないよう、コピーした内容のハッシュを採用する
+    temp_path = TEMPLATE_VERSIONS_DIR / f".import-{uuid.uuid4().hex}.tmp"
+    try:
+        content_hash = _copy_with_hash(template_path, temp_path)
+        os.replace(temp_path, template_version_path(content_hash))
+    finally:
+        temp_path.unlink(missing_ok=True)
+    return content_hash
+
+
+def publish_template_version(template_id: str, content_hash: str) -> Path:
+    """
+    テンプレートIDの最新版を指定バージョンに切り替える
+    一時ファイルへコピーしてから os.replace するため、読み込み中のリクエストが
+    書きかけのファイルを読むことはない（古いバージョンは .versions に残る）
+    """
+    template_path = TEMPLATES_DIR / f"{template_id}.pptx"
+    temp_path = TEMPLATES_DIR / f".{template_id}.{uuid.uuid4().hex}.tmp"
+    try:
+        # ハードリンクだと公開ファイルへの上書きがバージョンまで書き換えるためコピーする
+        shutil.copyfile(template_version_path(content_hash), temp_path)
+        stat_result = temp_path.stat()
+        os.replace(temp_path, template_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+    remember_content_hash(template_path, stat_result, content_hash)
+    return template_path
+
+
+@contextmanager
+def retain_template_version(content_hash: str) -> Iterator[str]:
+    """処理中のバージョンを prune_template_versions による削除から保護する"""
+    with _template_version_lock:
+        _template_version_refs[content_hash] = _template_version_refs.get(content_hash, 0) + 1
+    try:
+        yield content_hash
+    finally:
+        with _template_version_lock:
+            _template_version_refs[content_hash] -= 1
+            if not _template_version_refs[content_hash]:
+                del _template_version_refs[content_hash]
+
+
+@contextmanager
+def use_template_version(template_id: str) -> Iterator[str]:
+    """テンプレートIDを最新バージョンに解決し、ブロックを抜けるまでそのバージョンを保護する"""
+    while True:
+        content_hash = resolve_template_version(template_id)
+        with retain_template_version(content_hash):
+            version_path = template_version_path(content_hash)
+            try:
+                # 最終使用時刻として mtime を更新（他プロセスの削除判定に使う）
+                os.utime(version_path)
+            except FileNotFoundError:
+                # 解決してから保護するまでの間に削除された場合は解決し直す
+                continue
+            yield content_hash
+            return
+
+
+def prune_template_versions():
+    """
+    どのテンプレートIDの最新版でもなく、使用中でもない古いバージョンを削除
+    他プロセスが使用中の可能性を考え、最後に使われてから TEMPLATE_VERSION_GRACE_SECONDS 経つまでは残す
+    """
+    current = set()
+    for template_path in TEMPLATES_DIR.glob("*.pptx"):
+        try:
+            current.add(file_content_hash(template_path)[0])
+        except FileNotFoundError:
+            continue
+    expires_before = datetime.now().timestamp() - TEMPLATE_VERSION_GRACE_SECONDS
+    with _template_version_lock:
+        for version_path in TEMPLATE_VERSIONS_DIR.glob("*.pptx"):
+            content_hash = version_path.stem
+            if content_hash in current or content_hash in _template_version_refs:
+                continue
+            try:
+                if version_path.stat().st_mtime < expires_before:
+                    version_path.unlink()
+            except FileNotFoundError:
+                continue
+
+
+@lru_cache(maxsize=128)
+def load_template_schema(content_hash: Optional[str]) -> Tuple[Dict[str, Any], ...]:
+    """
+    テンプレートバージョンのレイアウト/プレースホルダー構造（バージョンは不変なので内容ハッシュでキャッシュ）
+    content_hash が None の場合は python-pptx の既定テンプレート
+    placeholders にはスライド追加時に複製されるもの（日付・フッター・番号以外）のみ含め、
+    継承されるフォントサイズ（font_size）も求めておく
+    """
+    prs = Presentation(str(template_version_path(content_hash))) if content_hash else Presentation()
+    return tuple(
+        {
+            "index": i,
+            "name": layout.name,
+            "placeholders": [
+                {**analyze_placeholder(ph), "font_size": placeholder_font_size(ph)}
+                for ph in layout.iter_cloneable_placeholders()
+            ],
+        }
+        for i, layout in enumerate(prs.slide_layouts)
+    )
+
+
+def load_template_layouts(content_hash: str) -> List[Dict[str, Any]]:
+    """テンプレートバージョンのレイアウト一覧"""
+    return [
+        {"index": layout["index"], "name": layout["name"]}
+        for layout in load_template_schema(content_hash)
+    ]
+
+
+def save_presentation(prs, output_filename: Optional[str], default_prefix: str) -> Tuple[str, str]:
+    """
+    OUTPUT_DIR に保存して (ファイル名, 内容ハッシュ) を返す
+    ファイル名が指定されなければリクエストごとに一意な名前を付ける
+    （削除が他のリクエストの出力に影響しないよう、内容が同じでもファイルは共有しない）
+    一時ファイルに保存してから置き換え、ダウンロード中のファイルが壊れないようにする
+    書き込むバイト列から内容ハッシュを求めてキャッシュし、ダウンロード時に読み直さずに済むようにする
+    """
+    # ZipFile はシークして書き戻すため、ファイルへ書きながらではなくメモリ上でハッシュを取る
+    buffer = io.BytesIO()
+    prs.save(buffer)
+    data = buffer.getbuffer()
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    output_filename = output_filename or f"{default_prefix}_{uuid.uuid4().hex[:8]}"
+    if not output_filename.endswith('.pptx'):
+        output_filename += '.pptx'
+    output_path = OUTPUT_DIR / output_filename
+    temp_path = output_path.with_name(f".{output_path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        stat_result = temp_path.stat()
+        os.replace(temp_path, output_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+        data.release()
+    remember_content_hash(output_path, stat_result, content_hash)
+    return output_filename, content_hash
+
+
+def resolve_layout_index(layout_index: int, layout_count: int) -> int:
+    """存在しないレイアウトが指定された場合は 0 を使う"""
+    return layout_index if 0 <= layout_index < layout_count else 0
+
+
+def assign_placeholders(
+    slide_content: SlideContent,
+    placeholders: List[Dict[str, Any]]
+) -> Dict[Any, List[Dict[str, Any]]]:
+    """
+    generate_presentation と同じ規則で、各フィールドが入るプレースホルダーを求める
+    キーは "title" / "subtitle" / "body" / "bullets" とカスタムプレースホルダーのidx
+    """
+    assigned: Dict[Any, List[Dict[str, Any]]] = {}
+    for ph in placeholders:
+        ph_idx = ph["idx"]
+        # slide.shapes.title は idx 0 のプレースホルダー
+        if slide_content.title and ph_idx == 0:
+            assigned.setdefault("title", []).append(ph)
+        if slide_content.subtitle and ph_idx == 1:
+            assigned.setdefault("subtitle", []).append(ph)
+        elif slide_content.body and "BODY" in ph["type"]:
+            assigned.setdefault("body", []).append(ph)
+        elif slide_content.bullets and "BODY" in ph["type"]:
+            assigned.setdefault("bullets", []).append(ph)
+        elif slide_content.placeholders and ph_idx in slide_content.placeholders:
+            assigned.setdefault(ph_idx, []).append(ph)
+    return assigned
+
+
+def plan_text_fit(
+    slide_content: SlideContent,
+    assigned: Dict[Any, List[Dict[str, Any]]]
+) -> Dict[str, Any]:
+    """
+    プレースホルダーの寸法に対してテキストの収まりを計算
+    max_sizes: 各フィールドのテンプレート上のフォントサイズ（縮小の上限）
+    font_sizes: 縮小が必要なフィールドのフォントサイズ
+    splits: 最小サイズでも収まらず分割が必要なフィールド（body / bullets）の段落チャンク
+    overflow: 分割できず最小サイズでもはみ出すフィールド（title / subtitle）
+    テキストを計測できない環境（Pillow に FreeType が無い）では何も計算しない
+    """
+    plan: Dict[str, Any] = {"max_sizes": {}, "font_sizes": {}, "splits": {}, "overflow": []}
+    if not metrics_available():
+        return plan
+    for name, default_size in AUTO_FIT_DEFAULT_FONT_SIZES.items():
+        value = getattr(slide_content, name)
+        # 同じ内容が複数のプレースホルダーに入る場合は最も小さいものに合わせる
+        sized = [ph for ph in assigned.get(name, []) if ph["width"] and ph["height"]]
+        if not value or not sized:
+            continue
+        ph = min(sized, key=lambda p: p["width"] * p["height"])
+        # テンプレートより大きくはしない（縮小のみ）
+        max_size = int(ph.get("font_size") or default_size)
+        plan["max_sizes"][name] = max_size
+
+        paragraphs = value if name == "bullets" else value.split("\n")
+        indent = BULLET_INDENT_PT if name == "bullets" else 0.0
+        size, chunks = fit_paragraphs(
+            paragraphs, ph["width"], ph["height"], max_size,
+            min_size=min(MIN_FONT_SIZE, max_size), indent_pt=indent
+        )
+        if size < max_size:
+            plan["font_sizes"][name] = size
+        if len(chunks) > 1:
+            if name in ("body", "bullets"):
+                plan["splits"][name] = chunks
+            else:
+                plan["overflow"].append(name)
+    return plan
+
+
+def apply_text_fit(
+    slide_content: SlideContent,
+    plan: Dict[str, Any]
+) -> List[Tuple[SlideContent, Dict[str, int]]]:
+    """計算結果に従ってスライドを続きのスライドに分割し、各スライドとフォントサイズの組を返す"""
+    splits = plan["splits"]
+    slide_count = max((len(chunks) for chunks in splits.values()), default=1)
+    planned = []
+    for i in range(slide_count):
+        update: Dict[str, Any] = {}
+        for name, chunks in splits.items():
+            chunk = chunks[i] if i < len(chunks) else None
+            if chunk and name == "body":
+                chunk = "\n".join(chunk)
+            update[name] = chunk
+        if i > 0:
+            # 続きのスライドにはタイトルと分割した内容のみを載せる
+            update.update(subtitle=None, notes=None, placeholders=None, image_path=None)
+            for name in ("body", "bullets"):
+                update.setdefault(name, None)
+            if slide_content.title:
+                update["title"] = f"{slide_content.title}{CONTINUATION_TITLE_SUFFIX}"
+        planned.append((slide_content.model_copy(update=update), plan["font_sizes"]))
+    return planned
+
+
+def auto_fit_slide(
+    slide_content: SlideContent,
+    layouts: Tuple[Dict[str, Any], ...]
+) -> List[Tuple[SlideContent, Dict[str, int]]]:
+    """スライド内容をレイアウトに合わせてオートフィット"""
+    layout = layouts[resolve_layout_index(slide_content.layout_index, len(layouts))]
+    assigned = assign_placeholders(slide_content, layout["placeholders"])
+    return apply_text_fit(slide_content, plan_text_fit(slide_content, assigned))
+
+
+def validate_slide(
+    slide_index: int,
+    slide_content: SlideContent,
+    layouts: Tuple[Dict[str, Any], ...]
+) -> SlideValidation:
+    """
+    スライド内容をレイアウト構造と照合する
+    generate_presentation の割り当て規則を再現し、反映されない内容やはみ出すテキストを報告する
+    """
+    diagnostics: List[SlideDiagnostic] = []
+    layout_index = resolve_layout_index(slide_content.layout_index, len(layouts))
+    if layout_index != slide_content.layout_index:
+        diagnostics.append(SlideDiagnostic(
+            level="error",
+            field="layout_index",
+            message=f"layout_index {slide_content.layout_index} does not exist "
+                    f"(valid: 0-{len(layouts) - 1}); layout 0 would be used",
+        ))
+    layout = layouts[layout_index]
+    assigned = assign_placeholders(slide_content, layout["placeholders"])
+
+    layout_label = f"layout {layout_index} ({layout['name']})"
+    if slide_content.title and "title" not in assigned:
+        diagnostics.append(SlideDiagnostic(
+            level="error", field="title",
+            message=f"{layout_label} has no title placeholder; title would be dropped",
+        ))
+    if slide_content.subtitle and "subtitle" not in assigned:
+        diagnostics.append(SlideDiagnostic(
+            level="error", field="subtitle",
+            message=f"{layout_label} has no placeholder with idx 1; subtitle would be dropped",
+        ))
+    for name in ("body", "bullets"):
+        if getattr(slide_content, name) and name not in assigned:
+            reason = "all BODY placeholders are used by body" if name == "bullets" and "body" in assigned \
+                else "it has no BODY placeholder"
+            diagnostics.append(SlideDiagnostic(
+                level="error", field=name,
+                message=f"{name} would be dropped on {layout_label}: {reason}",
+            ))
+    for ph_idx in sorted(set(slide_content.placeholders or {}) - set(assigned)):
+        diagnostics.append(SlideDiagnostic(
+            level="error", field=f"placeholders.{ph_idx}",
+            message=f"placeholder idx {ph_idx} is not available on {layout_label}",
+        ))
+    if slide_content.image_path:
+        diagnostics.append(SlideDiagnostic(
+            level="warning", field="image_path",
+            message="image_path is not supported yet and would be ignored",
+        ))
+
+    # テキストのはみ出し（auto_fit で縮小・分割される内容）
+    plan = plan_text_fit(slide_content, assigned)
+    for name, size in plan["font_sizes"].items():
+        if name in plan["splits"] or name in plan["overflow"]:
+            continue
+        diagnostics.append(SlideDiagnostic(
+            level="warning", field=name,
+            message=f"{name} overflows at {plan['max_sizes'][name]}pt; auto_fit would use {size}pt",
+        ))
+    for name, chunks in plan["splits"].items():
+        diagnostics.append(SlideDiagnostic(
+            level="warning", field=name,
+            message=f"{name} overflows even at {min(MIN_FONT_SIZE, plan['max_sizes'][name])}pt; "
+                    f"auto_fit would split it onto {len(chunks)} slides",
+        ))
+    for name in plan["overflow"]:
+        diagnostics.append(SlideDiagnostic(
+            level="warning", field=name,
+            message=f"{name} overflows even at {min(MIN_FONT_SIZE, plan['max_sizes'][name])}pt; shorten the text",
+        ))
+
+    return SlideValidation(
+        slide_index=slide_index,
+        layout_index=layout_index,
+        layout_name=layout["name"],
+        diagnostics=diagnostics,
+    )
+
+
+# ===== ダウンロード関連 =====
+
+def etag_matches(header_value: str, etag: str) -> bool:
+    """If-None-Match / If-Range ヘッダーがETagに一致するか判定"""
+    if header_value.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header_value.split(",")]
+    # If-None-Match は弱い比較
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def not_modified_since(header_value: str, mtime: float) -> bool:
+    """If-Modified-Since ヘッダー以降に更新されていないか判定"""
+    try:
+        since = parsedate_to_datetime(header_value)
+    except (TypeError, ValueError):
+        return False
+    return int(mtime) <= since.timestamp()
+
+
+def attachment_disposition(filename: str) -> str:
+    """Content-Disposition ヘッダー（ASCII以外を含むファイル名は RFC 5987 形式、Starlette の FileResponse と同じ）"""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range_header(header_value: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    Rangeヘッダーを解析して (start, end) を返す（endは含む）
+    単一レンジのみ対応し、解釈できない場合や不正なレンジ（bytes=5-3 など）は None（全体を返す）
+    正しいが充足不可能なレンジの場合は ValueError
+    """
+    match = _RANGE_PATTERN.match(header_value.strip().replace(" ", ""))
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+
+    start_str, end_str = match.groups()
+    if start_str == "":
+        # bytes=-N（末尾Nバイト）
+        suffix = int(end_str)
+        if suffix == 0:
+            raise ValueError("Unsatisfiable range")
+        start = max(file_size - suffix, 0)
+        end = file_size - 1
+    else:
+        start = int(start_str)
+        if end_str and int(end_str) < start:
+            # RFC 9110: 不正な range-spec は無視する
+            return None
+        end = min(int(end_str), file_size - 1) if end_str else file_size - 1
+
+    if start >= file_size or start > end:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+
+class FileRangeResponse(Response):
+    """
+    開いているファイルの全体または一部を返すレスポンス（送信後にファイルを閉じる）
+    サーバーがASGIの zerocopy 拡張に対応していれば sendfile で送信する
+    """
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        start: int,
+        length: int,
+        status_code: int = 200,
+        headers: Optional[Dict[str, str]] = None,
+        media_type: Optional[str] = None,
+        send_body: bool = True,
+    ):
+        self.file = file
+        self.start = start
+        self.length = length
+        self.send_body = send_body
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+        self.headers["content-length"] = str(length)
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await self._send(scope, send)
+        finally:
+            self.file.close()
+
+    async def _send(self, scope, send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+
+        if not self.send_body or self.length == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        if "http.response.zerocopy" in scope.get("extensions", {}):
+            await send({
+                "type": "http.response.zerocopy",
+                "file": self.file.fileno(),
+                "offset": self.start,
+                "count": self.length,
+                "more_body": False,
+            })
+            return
+
+        offset = self.start
+        remaining = self.length
+        while remaining > 0:
+            chunk = await anyio.to_thread.run_sync(
+                os.pread, self.file.fileno(), min(DOWNLOAD_CHUNK_SIZE, remaining), offset
+            )
+            if not chunk:
+                break
+            offset += len(chunk)
+            remaining -= len(chunk)
+            await send({
+                "type": "http.response.body",
+                "body": chunk,
+                "more_body": remaining > 0,
+            })
+        if remaining > 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+# ===== メールマージ =====
+
+_MERGE_FIELD_PATTERN = re.compile(r"\{\{\s*([^{}]+?)\s*\}\}")
+_UNSAFE_FILENAME_PATTERN = re.compile(r'[\\/:*?"<>|\s]+')
+_RELATIONSHIP_ATTRS = tuple(
+    f"{{http://schemas.openxmlformats.org/officeDocument/2006/relationships}}{name}"
+    for name in ("embed", "link", "id")
+)
+
+
+def render_merge_fields(value: Any, record: Dict[str, Any]) -> Any:
+    """文字列中の {{フィールド名}} をレコードの値に置換（dict / list は再帰的に処理）"""
+    if isinstance(value, str):
+        def replace(match):
+            field_value = record.get(match.group(1))
+            return "" if field_value is None else str(field_value)
+        return _MERGE_FIELD_PATTERN.sub(replace, value)
+    if isinstance(value, list):
+        return [render_merge_fields(item, record) for item in value]
+    if isinstance(value, dict):
+        return {key: render_merge_fields(item, record) for key, item in value.items()}
+    return value
+
+
+def replace_merge_fields_in_slide(slide, record: Dict[str, Any]):
+    """
+    スライド（とノート）のテキストに含まれる {{フィールド名}} を置換
+    PowerPoint はテキストを複数のランに分割することがあるため、段落単位で置換して先頭ランにまとめる
+    """
+    text_frames = [shape.text_frame for shape in slide.shapes if shape.has_text_frame]
+    if slide.has_notes_slide:
+        text_frames.append(slide.notes_slide.notes_text_frame)
+
+    for tf in text_frames:
+        for paragraph in tf.paragraphs:
+            runs = paragraph.runs
+            text = "".join(run.text for run in runs)
+            if "{{" not in text:
+                continue
+            runs[0].text = render_merge_fields(text, record)
+            for run in runs[1:]:
+                run._r.getparent().remove(run._r)
+
+
+def merge_record(slides, record: Dict[str, Any], content: Optional[Dict[str, Any]]):
+    """1レコード分の内容をスライド群に差し込む"""
+    if content:
+        fill_slides(slides, render_merge_fields(content.get("slides", []), record))
+    for slide in slides:
+        replace_merge_fields_in_slide(slide, record)
+
+
+def duplicate_slide(prs, source, filled: Optional[Tuple[bytes, Optional[str]]] = None):
+    """
+    スライドを複製して末尾に追加（画像などの関連パーツは元スライドと共有）
+    filled（差し込み済みのスライドXMLとノート）を指定した場合は、その内容で複製する
+    """
+    if filled:
+        element, notes_text = parse_xml(filled[0]), filled[1]
+    else:
+        element = source._element
+        notes_text = source.notes_slide.notes_text_frame.text if source.has_notes_slide else None
+
+    slide = prs.slides.add_slide(source.slide_layout)
+    for shape in list(slide.shapes):
+        shape._element.getparent().remove(shape._element)
+
+    rid_map = {}
+    for rel in source.part.rels.values():
+        if rel.reltype in (RT.SLIDE_LAYOUT, RT.NOTES_SLIDE):
+            continue
+        if rel.is_external:
+            rid_map[rel.rId] = slide.part.relate_to(rel.target_ref, rel.reltype, is_external=True)
+        else:
+            rid_map[rel.rId] = slide.part.relate_to(rel.target_part, rel.reltype)
+
+    background = element.cSld.bg
+    if background is not None:
+        slide._element.cSld.insert(0, copy.deepcopy(background))
+
+    for shape_element in element.cSld.spTree.iter_shape_elms():
+        shape_element = copy.deepcopy(shape_element)
+        for node in shape_element.iter():
+            for attr in _RELATIONSHIP_ATTRS:
+                if node.get(attr) in rid_map:
+                    node.set(attr, rid_map[node.get(attr)])
+        slide.shapes._spTree.insert_element_before(shape_element, "p:extLst")
+
+    if notes_text is not None:
+        slide.notes_slide.notes_text_frame.text = notes_text
+    return slide
+
+
+def iter_merge_records(
+    records_path: Path,
+    records_format: str
+) -> Iterator[Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+    """
+    レコードファイルを1件ずつ読み込み、(レコード, エラー) を返す
+    CSVの構文エラーや文字コードの誤りで以降を読めない場合は、エラーを1件返して打ち切る
+    """
+    with open(records_path, encoding="utf-8-sig", newline="") as f:
+        try:
+            if records_format == "csv":
+                reader = csv.DictReader(f)
+                for record in reader:
+                    yield record, None
+                return
+
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield None, f"line {line_no}: invalid JSON: {e}"
+                    continue
+                if not isinstance(record, dict):
+                    yield None, f"line {line_no}: record must be a JSON object"
+                    continue
+                yield record, None
+        except (csv.Error, UnicodeDecodeError) as e:
+            yield None, f"records file could not be read past this point: {e}"
+
+
+def count_merge_records(records_path: Path, records_format: str) -> int:
+    """レコードの件数（読み込めなかった行を含む。1件ずつ読み飛ばすのでメモリ使用量は件数に依存しない）"""
+    return sum(1 for _ in iter_merge_records(records_path, records_format))
+
+
+_merge_executor: Optional[Executor] = None
+_merge_executor_lock = threading.Lock()
+
+
+@lru_cache(maxsize=MERGE_TEMPLATE_CACHE_SIZE)
+def load_merge_template(content_hash: str):
+    """
+    解析済みのテンプレートバージョン（プロセスごとに一度だけ解析する）
+    共有されるので変更せず、レコードごとに copy.deepcopy して使う（再解析の約1/3のコスト）
+    """
+    return Presentation(str(template_version_path(content_hash)))
+
+
+def _render_merge_record(
+    content_hash: str,
+    content: Optional[Dict[str, Any]],
+    record: Dict[str, Any]
+) -> Tuple[Optional[bytes], Optional[str]]:
+    """1レコード分のデッキを生成して (pptxバイト列, エラー) を返す"""
+    try:
+        prs = copy.deepcopy(load_merge_template(content_hash))
+        merge_record(list(prs.slides), record, content)
+        buffer = io.BytesIO()
+        prs.save(buffer)
+        return buffer.getvalue(), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _render_merge_slides(
+    content_hash: str,
+    content: Optional[Dict[str, Any]],
+    record: Dict[str, Any]
+) -> Tuple[Optional[List[Tuple[bytes, Optional[str]]]], Optional[str]]:
+    """1レコード分を差し込んだテンプレートスライドを [(スライドXML, ノート)] として返す（mode=combined 用）"""
+    try:
+        prs = copy.deepcopy(load_merge_template(content_hash))
+        slides = list(prs.slides)
+        merge_record(slides, record, content)
+        return [
+            (
+                etree.tostring(slide._element),
+                slide.notes_slide.notes_text_frame.text if slide.has_notes_slide else None,
+            )
+            for slide in slides
+        ], None
+    except Exception as e:
+        return None, str(e)
+
+
+class _InlineExecutor(Executor):
+    """ワーカープロセスを使わずに呼び出し元スレッドで実行する Executor"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def get_merge_executor() -> Executor:
+    """
+    全リクエストで共有するマージ用 Executor（初回使用時に作成）
+    リクエスト固有の情報はタスクの引数で渡し、ワーカーにはリクエストをまたぐ状態を持たせない
+    """
+    global _merge_executor
+    with _merge_executor_lock:
+        if _merge_executor is None:
+            if MERGE_WORKERS <= 1:
+                _merge_executor = _InlineExecutor()
+            else:
+                _merge_executor = ProcessPoolExecutor(
+                    max_workers=MERGE_WORKERS,
+                    # リクエスト処理中のスレッドから fork しないよう spawn を使う
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+        return _merge_executor
+
+
+def discard_merge_executor(executor: Executor):
+    """ワーカーが異常終了した Executor を破棄し、次に使うときに作り直させる"""
+    global _merge_executor
+    with _merge_executor_lock:
+        if _merge_executor is executor:
+            _merge_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def submit_merge_task(fn: Callable[[Any], Any], arg: Any) -> Tuple[Executor, Future]:
+    """共有 Executor にタスクを投入（壊れていれば作り直して投入し直す）"""
+    executor = get_merge_executor()
+    try:
+        return executor, executor.submit(fn, arg)
+    except BrokenProcessPool:
+        discard_merge_executor(executor)
+        executor = get_merge_executor()
+        return executor, executor.submit(fn, arg)
+
+
+def merge_task_result(executor: Optional[Executor], future: Future) -> Tuple[Any, Optional[str]]:
+    """タスクの (結果, エラー)。ワーカーの異常終了などで結果を得られない場合もエラーとして返す"""
+    try:
+        return future.result()
+    except BrokenProcessPool as e:
+        discard_merge_executor(executor)
+        return None, f"merge worker terminated abruptly: {e}"
+    except Exception as e:
+        return None, str(e)
+
+
+def bounded_map(
+    fn: Callable[[Any], Tuple[Any, Optional[str]]],
+    items: Iterable[Tuple[Any, Tuple[Any, Optional[str]]]],
+    max_in_flight: int
+) -> Iterator[Tuple[Any, Tuple[Any, Optional[str]]]]:
+    """
+    (タグ, (引数, エラー)) ごとに fn(引数) を共有 Executor で実行し、入力順に (タグ, (結果, エラー)) を返す
+    入力側のエラーはそのまま同じ位置に返すので、呼び出し側で並べ替える必要はない
+    処理中の件数を max_in_flight までに抑え、入力全体をメモリに載せない
+    例外は呼び出し元に伝えずエラーとして返す（ストリーミング中のレスポンスが途切れないように）
+    """
+    pending = deque()
+    for tag, (arg, error) in items:
+        if error:
+            failed = Future()
+            failed.set_result((None, error))
+            pending.append((tag, None, failed))
+        else:
+            pending.append((tag, *submit_merge_task(fn, arg)))
+        if len(pending) >= max_in_flight:
+            tag, executor, future = pending.popleft()
+            yield tag, merge_task_result(executor, future)
+    while pending:
+        tag, executor, future = pending.popleft()
+        yield tag, merge_task_result(executor, future)
+
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """ZipFile の出力を溜めておき、順次取り出すためのシーク不可ストリーム"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def merge_entry_name(index: int, record: Dict[str, Any], filename_field: Optional[str]) -> str:
+    """
+    ZIP内のファイル名（連番_filename_field の値、無ければ record_連番）
+    連番を付けて重複を避けるので、使用済みの名前を覚えておく必要はない
+    """
+    base = ""
+    if filename_field and record.get(filename_field) is not None:
+        base = _UNSAFE_FILENAME_PATTERN.sub("_", str(record[filename_field])).strip("._")
+    if base:
+        return f"{index:05d}_{base}.pptx"
+    return f"record_{index:05d}.pptx"
+
+
+def _numbered_merge_records(
+    records: Iterable[Tuple[Optional[Dict[str, Any]], Optional[str]]]
+) -> Iterator[Tuple[Tuple[int, Optional[Dict[str, Any]]], Tuple[Optional[Dict[str, Any]], Optional[str]]]]:
+    """(レコード, エラー) に1始まりの番号を付け、bounded_map の入力 ((番号, レコード), (レコード, エラー)) にする"""
+    for index, (record, error) in enumerate(records, 1):
+        yield (index, record), (record, error)
+
+
+def stream_merge_zip(
+    content_hash: str,
+    content: Optional[Dict[str, Any]],
+    records_path: Path,
+    records_format: str,
+    filename_field: Optional[str]
+) -> Iterator[bytes]:
+    """
+    レコードごとにデッキを生成し、ZIPとして順次出力する
+    失敗したレコード（読み込めなかった行を含む）は errors.ndjson にまとめてZIPの末尾に含める
+    エラーは一時ファイルに書き出し、件数が多くてもメモリに溜めない
+    """
+    buffer = _ZipStreamBuffer()
+    try:
+        with retain_template_version(content_hash), \
+                tempfile.TemporaryFile(dir=TEMP_DIR) as errors_file:
+            # pptx は圧縮済みなので再圧縮しない
+            with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+                results = bounded_map(
+                    partial(_render_merge_record, content_hash, content),
+                    _numbered_merge_records(iter_merge_records(records_path, records_format)),
+                    max(1, MERGE_WORKERS) * MERGE_IN_FLIGHT_PER_WORKER,
+                )
+                for (index, record), (deck, error) in results:
+                    if error:
+                        line = json.dumps({"record": index, "error": error}, ensure_ascii=False) + "\n"
+                        errors_file.write(line.encode("utf-8"))
+                        continue
+                    archive.writestr(merge_entry_name(index, record, filename_field), deck)
+                    yield buffer.drain()
+
+                if errors_file.tell():
+                    errors_file.seek(0)
+                    with archive.open("errors.ndjson", "w") as entry:
+                        for chunk in iter(partial(errors_file.read, 64 * 1024), b""):
+                            entry.write(chunk)
+                            yield buffer.drain()
+            yield buffer.drain()
+    finally:
+        records_path.unlink(missing_ok=True)
+
+
+def build_combined_merge_deck(
+    content_hash: str,
+    content: Optional[Dict[str, Any]],
+    records_path: Path,
+    records_format: str
+) -> Tuple[Any, int, List[Dict[str, Any]]]:
+    """
+    テンプレートのスライド群をレコードごとに複製して差し込み、1つのデッキにまとめる
+    差し込みはワーカーで行い、ここでは差し込み済みのスライドを順に追加するだけにする
+    戻り値は (Presentation, 差し込んだレコード数, エラー一覧)
+    """
+    # 上限を超える場合は何も生成せずに断る（エラー一覧もレスポンスに載るので、読み込めなかった行も数える）
+    if count_merge_records(records_path, records_format) > MERGE_MAX_COMBINED_RECORDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many records for mode=combined (max {MERGE_MAX_COMBINED_RECORDS}); "
+                   f"use mode=per_record"
+        )
+
+    prs = copy.deepcopy(load_merge_template(content_hash))
+    template_slides = list(prs.slides)
+    errors: List[Dict[str, Any]] = []
+    merged = 0
+    results = bounded_map(
+        partial(_render_merge_slides, content_hash, content),
+        _numbered_merge_records(iter_merge_records(records_path, records_format)),
+        max(1, MERGE_WORKERS) * MERGE_IN_FLIGHT_PER_WORKER,
+    )
+    for (index, _), (filled_slides, error) in results:
+        if error:
+            errors.append({"record": index, "error": error})
+            continue
+        for source, filled in zip(template_slides, filled_slides):
+            duplicate_slide(prs, source, filled)
+        merged += 1
+
+    # 複製元のテンプレートスライドを削除
+    remove_leading_slides(prs, len(template_slides))
+    return prs, merged, errors
 
 
 # ===== API Endpoints =====
@@ -185,13 +1275,8 @@ async def list_templates():
     for pptx_file in TEMPLATES_DIR.glob("*.pptx"):
         template_id = pptx_file.stem
         try:
-            prs = Presentation(str(pptx_file))
-            layouts = []
-            for i, layout in enumerate(prs.slide_layouts):
-                layouts.append({
-                    "index": i,
-                    "name": layout.name
-                })
+            with use_template_version(template_id) as content_hash:
+                layouts = load_template_layouts(content_hash)
 
             templates.append(TemplateInfo(
                 id=template_id,
@@ -199,7 +1284,8 @@ async def list_templates():
                 description=f"Template: {template_id}",
                 layouts=layouts,
                 created_at=datetime.fromtimestamp(pptx_file.stat().st_mtime).isoformat(),
-                file_path=str(pptx_file)
+                file_path=str(pptx_file),
+                version=content_hash
             ))
         except Exception as e:
             print(f"Error loading template {template_id}: {e}")
@@ -219,25 +1305,45 @@ async def upload_template(
 
     # テンプレートIDを生成または使用
     tid = template_id or Path(file.filename).stem
-    template_path = TEMPLATES_DIR / f"{tid}.pptx"
 
-    # ファイルを保存
-    with open(template_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
-
-    # テンプレート情報を返す
-    prs = Presentation(str(template_path))
-    layouts = []
-    for i, layout in enumerate(prs.slide_layouts):
-        layouts.append({
-            "index": i,
-            "name": layout.name
-        })
+    # 一時ファイルへストリーミングしながらハッシュを計算
+    # （os.replace で原子的に公開できるよう、バージョン置き場と同じディレクトリに置く）
+    temp_path = TEMPLATE_VERSIONS_DIR / f".upload-{uuid.uuid4().hex}.tmp"
+    digest = hashlib.sha256()
+    try:
+        with open(temp_path, "wb") as f:
+            while chunk := await file.read(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+        content_hash = digest.hexdigest()
+
+        # 公開が終わるまで古いバージョンの削除対象にならないよう保護する
+        with retain_template_version(content_hash):
+            # 不変のバージョンとして公開（同一内容なら既存バージョンをそのまま使う）
+            version_path = template_version_path(content_hash)
+            is_new_version = not version_path.exists()
+            if is_new_version:
+                os.replace(temp_path, version_path)
+
+            try:
+                layouts = load_template_layouts(content_hash)
+            except Exception:
+                if is_new_version:
+                    version_path.unlink(missing_ok=True)
+                raise HTTPException(status_code=400, detail="Invalid .pptx file")
+
+            # テンプレートIDの最新版を切り替え
+            publish_template_version(tid, content_hash)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+    # 置き換えられた古いバージョンを整理
+    await run_in_threadpool(prune_template_versions)
 
     return {
         "message": "Template uploaded successfully",
         "template_id": tid,
+        "version": content_hash,
         "layouts": layouts
     }
 
@@ -245,8 +1351,8 @@ async def upload_template(
 @app.get("/templates/{template_id}/analyze", response_model=TemplateAnalysis)
 async def analyze_template(template_id: str):
     """テンプレートの構造を解析"""
-    template_path = get_template_path(template_id)
-    prs = Presentation(str(template_path))
+    with use_template_version(template_id) as content_hash:
+        prs = Presentation(str(template_version_path(content_hash)))
 
     # スライドマスター情報
     slide_masters = []
@@ -289,7 +1395,8 @@ async def analyze_template(template_id: str):
         template_id=template_id,
         slide_masters=slide_masters,
         layouts=layouts,
-        slides=slides
+        slides=slides,
+        version=content_hash
     )
 
 
@@ -298,14 +1405,13 @@ async def generate_presentation(request: PresentationRequest):
     """プレゼンテーションを生成"""
 
     # テンプレートを読み込むか新規作成
+    template_version = None
     if request.template_id:
-        template_path = get_template_path(request.template_id)
-        prs = Presentation(str(template_path))
+        # 解決したバージョンは不変なので、生成中にアップロードがあっても影響を受けない
+        with use_template_version(request.template_id) as template_version:
+            prs = Presentation(str(template_version_path(template_version)))
         # テンプレートの既存スライドを削除（レイアウトのみ使用）
-        while len(prs.slides) > 0:
-            rId = prs.slides._sldIdLst[0].rId
-            prs.part.drop_rel(rId)
-            del prs.slides._sldIdLst[0]
+        remove_leading_slides(prs, len(prs.slides))
     else:
         prs = Presentation()
 
@@ -319,18 +1425,29 @@ async def generate_presentation(request: PresentationRequest):
         if "subject" in request.metadata:
             core_props.subject = request.metadata["subject"]
 
+    # オートフィット（フォント縮小・続きのスライドへの分割）
+    planned_slides = [(slide_content, {}) for slide_content in request.slides]
+    if request.auto_fit:
+        layouts = load_template_schema(template_version)
+        planned_slides = [
+            planned
+            for slide_content in request.slides
+            for planned in auto_fit_slide(slide_content, layouts)
+        ]
+
     # スライドを追加
-    for slide_content in request.slides:
-        layout_index = slide_content.layout_index
-        if layout_index >= len(prs.slide_layouts):
-            layout_index = 0
+    for slide_content, font_sizes in planned_slides:
+        layout_index = resolve_layout_index(slide_content.layout_index, len(prs.slide_layouts))
 
         slide_layout = prs.slide_layouts[layout_index]
         slide = prs.slides.add_slide(slide_layout)
 
         # タイトルを設定
         if slide_content.title and slide.shapes.title:
-            slide.shapes.title.text = slide_content.title
+            if "title" in font_sizes:
+                set_text_in_placeholder(slide.shapes.title, slide_content.title, font_sizes["title"])
+            else:
+                slide.shapes.title.text = slide_content.title
 
         # プレースホルダーにコンテンツを設定
         for shape in slide.shapes:
@@ -340,15 +1457,15 @@ async def generate_presentation(request: PresentationRequest):
 
                 # サブタイトル（通常idx=1）
                 if slide_content.subtitle and ph_idx == 1:
-                    set_text_in_placeholder(shape, slide_content.subtitle)
+                    set_text_in_placeholder(shape, slide_content.subtitle, font_sizes.get("subtitle"))
 
                 # 本文テキスト
                 elif slide_content.body and "BODY" in ph_type:
-                    set_text_in_placeholder(shape, slide_content.body)
+                    set_text_in_placeholder(shape, slide_content.body, font_sizes.get("body"))
 
                 # 箇条書き
                 elif slide_content.bullets and "BODY" in ph_type:
-                    add_bullets_to_placeholder(shape, slide_content.bullets)
+                    add_bullets_to_placeholder(shape, slide_content.bullets, font_sizes.get("bullets"))
 
                 # カスタムプレースホルダーマッピング
                 elif slide_content.placeholders and ph_idx in slide_content.placeholders:
@@ -360,21 +1477,47 @@ async def generate_presentation(request: PresentationRequest):
             notes_slide.notes_text_frame.text = slide_content.notes
 
     # ファイルを保存
-    output_filename = request.output_filename or f"presentation_{uuid.uuid4().hex[:8]}.pptx"
-    if not output_filename.endswith('.pptx'):
-        output_filename += '.pptx'
-    output_path = OUTPUT_DIR / output_filename
-    prs.save(str(output_path))
+    output_filename, _ = save_presentation(prs, request.output_filename, "presentation")
 
     return {
         "success": True,
         "message": "Presentation generated successfully",
         "filename": output_filename,
         "download_url": f"/download/{output_filename}",
-        "slide_count": len(prs.slides)
+        "slide_count": len(prs.slides),
+        "template_version": template_version
     }
 
 
+@app.post("/generate/validate", response_model=ValidationResult)
+async def validate_presentation(request: PresentationRequest):
+    """
+    プレゼンテーション生成リクエストを検証（ドライラン）
+    PPTXを開かず、キャッシュ済みのレイアウト構造と照合してスライドごとの問題を返す
+    """
+    if request.template_id:
+        with use_template_version(request.template_id) as template_version:
+            layouts = load_template_schema(template_version)
+    else:
+        template_version = None
+        layouts = load_template_schema(None)
+
+    slides = [
+        validate_slide(i, slide_content, layouts)
+        for i, slide_content in enumerate(request.slides)
+    ]
+
+    diagnostics = [d for slide in slides for d in slide.diagnostics]
+    error_count = sum(1 for d in diagnostics if d.level == "error")
+    return ValidationResult(
+        valid=error_count == 0,
+        template_version=template_version,
+        error_count=error_count,
+        warning_count=len(diagnostics) - error_count,
+        slides=slides,
+    )
+
+
 @app.post("/generate/from-json")
 async def generate_from_json(
     json_content: str = Form(...),
@@ -387,7 +1530,8 @@ async def generate_from_json(
             template_id=template_id,
             slides=[SlideContent(**slide) for slide in data.get("slides", [])],
             output_filename=data.get("output_filename"),
-            metadata=data.get("metadata")
+            metadata=data.get("metadata"),
+            auto_fit=data.get("auto_fit", False)
         )
         return await generate_presentation(request)
     except json.JSONDecodeError as e:
@@ -396,18 +1540,86 @@ async def generate_from_json(
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/download/{filename}")
-async def download_file(filename: str):
-    """生成したファイルをダウンロード"""
+@app.api_route("/download/{filename}", methods=["GET", "HEAD"])
+async def download_file(filename: str, request: Request):
+    """
+    生成したファイルをダウンロード
+    ETag / Last-Modified による条件付きGET、Rangeによる部分取得、HEADに対応
+    """
     file_path = OUTPUT_DIR / filename
-    if not file_path.exists():
+    if not file_path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    try:
+        file = await run_in_threadpool(open, file_path, "rb")
+    except OSError:
         raise HTTPException(status_code=404, detail="File not found")
 
-    return FileResponse(
-        path=str(file_path),
-        filename=filename,
-        media_type="application/vnd.openxmlformats-officedocument.presentationml.presentation"
-    )
+    # ETag・長さ・本文をすべて同じファイルディスクリプタから得るため、
+    # 途中でファイルが置き換えられても送信内容とヘッダーが食い違わない
+    try:
+        # save_presentation で保存したファイルはハッシュがキャッシュ済みなので stat のみで済む
+        content_hash, stat_result = await run_in_threadpool(open_file_content_hash, file, file_path)
+        etag = f'"{content_hash[:32]}"'
+        file_size = stat_result.st_size
+        validators = {
+            "etag": etag,
+            "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+            "accept-ranges": "bytes",
+        }
+
+        # 条件付きGET（If-None-Match を優先）
+        if_none_match = request.headers.get("if-none-match")
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_none_match is not None:
+            if etag_matches(if_none_match, etag):
+                file.close()
+                return Response(status_code=304, headers=validators)
+        elif if_modified_since and not_modified_since(if_modified_since, stat_result.st_mtime):
+            file.close()
+            return Response(status_code=304, headers=validators)
+
+        headers = {
+            **validators,
+            "content-disposition": attachment_disposition(filename),
+        }
+        send_body = request.method != "HEAD"
+
+        # Range（If-Range が一致しない場合は全体を返す）
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (if_range is None or if_range.strip() == etag):
+            try:
+                byte_range = parse_range_header(range_header, file_size)
+            except ValueError:
+                file.close()
+                return Response(
+                    status_code=416,
+                    headers={**validators, "content-range": f"bytes */{file_size}"},
+                )
+            if byte_range is not None:
+                start, end = byte_range
+                headers["content-range"] = f"bytes {start}-{end}/{file_size}"
+                return FileRangeResponse(
+                    file,
+                    start=start,
+                    length=end - start + 1,
+                    status_code=206,
+                    headers=headers,
+                    media_type=PPTX_MEDIA_TYPE,
+                    send_body=send_body,
+                )
+
+        return FileRangeResponse(
+            file,
+            start=0,
+            length=file_size,
+            headers=headers,
+            media_type=PPTX_MEDIA_TYPE,
+            send_body=send_body,
+        )
+    except BaseException:
+        file.close()
+        raise
 
 
 @app.delete("/files/{filename}")
@@ -416,6 +1628,7 @@ async def delete_file(filename: str):
     file_path = OUTPUT_DIR / filename
     if file_path.exists():
         file_path.unlink()
+        forget_content_hash(file_path)
         return {"message": f"File {filename} deleted"}
     raise HTTPException(status_code=404, detail="File not found")
 
@@ -426,53 +1639,95 @@ async def fill_template(template_id: str, content: Dict[str, Any]):
     テンプレートのスライドを維持しながらコンテンツを埋める
     既存スライドの構造を保持したまま、テキストのみ置換
     """
-    template_path = get_template_path(template_id)
-    prs = Presentation(str(template_path))
+    with use_template_version(template_id) as content_hash:
+        prs = Presentation(str(template_version_path(content_hash)))
 
-    slides_content = content.get("slides", [])
+    fill_slides(list(prs.slides), content.get("slides", []))
 
-    for i, slide in enumerate(prs.slides):
-        if i >= len(slides_content):
-            break
+    # 保存
+    output_filename, _ = save_presentation(prs, content.get("output_filename"), f"filled_{template_id}")
 
-        slide_data = slides_content[i]
+    return {
+        "success": True,
+        "message": "Template filled successfully",
+        "filename": output_filename,
+        "download_url": f"/download/{output_filename}",
+        "slide_count": len(prs.slides),
+        "template_version": content_hash
+    }
 
-        for shape in slide.shapes:
-            if shape.is_placeholder:
-                ph_idx = shape.placeholder_format.idx
 
-                # タイトル（通常idx=0）
-                if ph_idx == 0 and "title" in slide_data:
-                    set_text_in_placeholder(shape, slide_data["title"])
 
-                # サブタイトル/本文（通常idx=1以上）
-                elif ph_idx == 1 and "subtitle" in slide_data:
-                    set_text_in_placeholder(shape, slide_data["subtitle"])
+@app.post("/templates/{template_id}/merge")
+async def merge_template(
+    template_id: str,
+    records: UploadFile = File(...),
+    mode: str = Form("per_record"),
+    content: Optional[str] = Form(None),
+    records_format: Optional[str] = Form(None),
+    filename_field: Optional[str] = Form(None),
+    output_filename: Optional[str] = Form(None)
+):
+    """
+    メールマージ：1つのテンプレートに多数のレコード（CSV / NDJSON）を差し込む
+    mode=per_record はレコードごとのデッキをZIPでストリーミング、mode=combined は1つのデッキにまとめる
+    テンプレート内の {{フィールド名}} と、content（fill と同じ形式）内の {{フィールド名}} を置換する
+    """
+    if mode not in ("per_record", "combined"):
+        raise HTTPException(status_code=400, detail="mode must be 'per_record' or 'combined'")
 
-                # カスタムマッピング
-                elif "placeholders" in slide_data:
-                    ph_key = str(ph_idx)
-                    if ph_key in slide_data["placeholders"]:
-                        set_text_in_placeholder(shape, slide_data["placeholders"][ph_key])
+    records_format = records_format or MERGE_RECORD_FORMATS.get(Path(records.filename or "").suffix.lower())
+    if records_format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="records_format must be 'csv' or 'ndjson'")
 
-        # ノート
-        if "notes" in slide_data:
-            notes_slide = slide.notes_slide
-            notes_slide.notes_text_frame.text = slide_data["notes"]
+    merge_content = None
+    if content:
+        try:
+            merge_content = json.loads(content)
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
+
+    with use_template_version(template_id) as content_hash:
+        # レコードはリクエスト終了後も読むため、一時ファイルにストリーミングで保存
+        records_path = TEMP_DIR / f"merge-{uuid.uuid4().hex}.{records_format}"
+        with open(records_path, "wb") as f:
+            while chunk := await records.read(HASH_CHUNK_SIZE):
+                f.write(chunk)
+
+        if mode == "per_record":
+            zip_filename = output_filename or f"merged_{template_id}_{uuid.uuid4().hex[:8]}"
+            if not zip_filename.endswith(".zip"):
+                zip_filename += ".zip"
+            # ストリーミング中は stream_merge_zip がバージョンを保持する
+            return StreamingResponse(
+                stream_merge_zip(content_hash, merge_content, records_path, records_format, filename_field),
+                media_type="application/zip",
+                headers={
+                    "content-disposition": attachment_disposition(zip_filename),
+                    "x-template-version": content_hash,
+                },
+            )
 
-    # 保存
-    output_filename = content.get("output_filename", f"filled_{template_id}_{uuid.uuid4().hex[:8]}.pptx")
-    if not output_filename.endswith('.pptx'):
-        output_filename += '.pptx'
-    output_path = OUTPUT_DIR / output_filename
-    prs.save(str(output_path))
+        try:
+            prs, record_count, errors = await run_in_threadpool(
+                build_combined_merge_deck, content_hash, merge_content, records_path, records_format
+            )
+        finally:
+            records_path.unlink(missing_ok=True)
+
+    output_filename, _ = await run_in_threadpool(
+        save_presentation, prs, output_filename, f"merged_{template_id}"
+    )
 
     return {
         "success": True,
-        "message": "Template filled successfully",
+        "message": "Template merged successfully",
         "filename": output_filename,
         "download_url": f"/download/{output_filename}",
-        "slide_count": len(prs.slides)
+        "slide_count": len(prs.slides),
+        "record_count": record_count,
+        "errors": errors,
+        "template_version": content_hash
     }
 
 
@@ -0,0 +1,252 @@
+"""
+テキスト計測・オートフィット
+Pillow のフォントメトリクスでテキスト幅を計測し、プレースホルダーに収まるか判定する
+グリフ幅テーブルは (フォント, サイズ) ごとにキャッシュし、文字列幅は辞書参照の累積和で求める
+"""
+
+import os
+import re
+import unicodedata
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
+from typing import Optional, List, Tuple
+
+from PIL import ImageFont, features
+
+
+# ===== 設定 =====
+
+# 計測に使うフォント（未指定時は候補から最初に見つかったもの）
+FONT_PATH_ENV = "PPTX_FONT_PATH"
+FONT_CANDIDATES = [
+    "C:/Windows/Fonts/meiryo.ttc",
+    "C:/Windows/Fonts/YuGothM.ttc",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+]
+
+MIN_FONT_SIZE = 10
+LINE_SPACING = 1.2
+# テキストフレームの既定余白（左右 0.1インチ、上下 0.05インチ）
+MARGIN_X_PT = 0.1 * 72 * 2
+MARGIN_Y_PT = 0.05 * 72 * 2
+# 箇条書き（レベル0）のインデント
+BULLET_INDENT_PT = 0.375 * 72
+
+# 改行位置の単位：全角文字は1文字ずつ、それ以外は単語（後続の空白を含む）
+_TOKEN_PATTERN = re.compile(
+    r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+    r"|[^\s\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]+\s*"
+    r"|\s+"
+)
+
+
+@lru_cache(maxsize=1)
+def resolve_font_path() -> Optional[str]:
+    """計測用フォントのパスを解決（見つからなければ Pillow の既定フォント）"""
+    configured = os.environ.get(FONT_PATH_ENV)
+    if configured and os.path.exists(configured):
+        return configured
+    for candidate in FONT_CANDIDATES:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+@lru_cache(maxsize=1)
+def metrics_available() -> bool:
+    """
+    サイズを指定した計測ができるか
+    FreeType の無い Pillow ではビットマップフォントになりサイズが無視されるため、オートフィットは行わない
+    """
+    return bool(features.check("freetype2"))
+
+
+class GlyphWidthTable(dict):
+    """
+    1つの (フォント, サイズ) に対する文字幅テーブル（単位: pt）
+    未計測の文字は初回参照時に Pillow で計測して登録する
+    """
+
+    def __init__(self, font_path: Optional[str], size: int):
+        super().__init__()
+        self.size = size
+        if font_path:
+            self.font = ImageFont.truetype(font_path, size)
+        else:
+            # サイズ指定の既定フォントは Pillow 10.1 以降（FreeType 必須）
+            self.font = ImageFont.load_default(size)
+        if not isinstance(self.font, ImageFont.FreeTypeFont):
+            raise RuntimeError("Text metrics require Pillow with FreeType support")
+        # 全角グリフを持たないフォントでは全角文字を1em として扱う
+        self.wide_fallback = self.font.getlength("\u3042") < size * 0.8
+        for code in range(0x20, 0x7F):
+            self[chr(code)]
+
+    def __missing__(self, char: str) -> float:
+        if self.wide_fallback and unicodedata.east_asian_width(char) in ("W", "F"):
+            width = float(self.size)
+        else:
+            width = self.font.getlength(char)
+        self[char] = width
+        return width
+
+    def text_width(self, text: str) -> float:
+        """文字列幅（文字幅の合計、カーニングは考慮しない）"""
+        return sum(map(self.__getitem__, text))
+
+
+@lru_cache(maxsize=256)
+def get_glyph_widths(font_path: Optional[str], size: int) -> GlyphWidthTable:
+    """(フォント, サイズ) ごとの文字幅テーブルを取得"""
+    return GlyphWidthTable(font_path, size)
+
+
+@lru_cache(maxsize=4096)
+def _break_points(text: str) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    """改行可能な単位ごとの (開始位置, 末尾の空白を除いた終了位置)"""
+    starts = []
+    visible_ends = []
+    for match in _TOKEN_PATTERN.finditer(text):
+        starts.append(match.start())
+        visible_ends.append(match.start() + len(match.group().rstrip()))
+    return tuple(starts), tuple(visible_ends)
+
+
+def count_lines(text: str, font_size: int, width_pt: float, font_path: Optional[str] = None) -> int:
+    """
+    指定幅で折り返したときの行数
+    文字幅の累積和を一度だけ求め、各行の折り返し位置は二分探索で決める
+    """
+    if width_pt <= 0:
+        return 1
+    widths = get_glyph_widths(font_path or resolve_font_path(), font_size)
+    offsets = [0.0, *accumulate(map(widths.__getitem__, text))]
+    if offsets[-1] <= width_pt:
+        return 1
+
+    starts, visible_ends = _break_points(text)
+    visible_x = [offsets[end] for end in visible_ends]
+    token_count = len(starts)
+    lines = 1
+    i = 0
+    while True:
+        line_start = offsets[starts[i]]
+        # この行に収まる最後の単位の次
+        j = bisect_right(visible_x, line_start + width_pt, lo=i)
+        if j >= token_count:
+            return lines
+        if j == i:
+            # 1行に収まらない単語は文字単位で折り返される
+            lines += int((visible_x[i] - line_start) // width_pt)
+            j = i + 1
+            if j >= token_count:
+                return lines
+        i = j
+        lines += 1
+
+
+def text_height(
+    paragraphs: List[str],
+    font_size: int,
+    width_pt: float,
+    indent_pt: float = 0.0,
+    font_path: Optional[str] = None
+) -> float:
+    """段落リストを折り返したときの高さ（pt）"""
+    line_count = sum(
+        count_lines(paragraph, font_size, width_pt - indent_pt, font_path)
+        for paragraph in paragraphs
+    )
+    return line_count * font_size * LINE_SPACING
+
+
+def fits(
+    paragraphs: List[str],
+    font_size: int,
+    box_width_in: float,
+    box_height_in: float,
+    indent_pt: float = 0.0,
+    font_path: Optional[str] = None
+) -> bool:
+    """段落リストがプレースホルダー（インチ指定）に収まるか"""
+    width_pt = box_width_in * 72 - MARGIN_X_PT
+    height_pt = box_height_in * 72 - MARGIN_Y_PT
+    return text_height(paragraphs, font_size, width_pt, indent_pt, font_path) <= height_pt
+
+
+def fit_font_size(
+    paragraphs: List[str],
+    box_width_in: float,
+    box_height_in: float,
+    max_size: int,
+    min_size: int = MIN_FONT_SIZE,
+    indent_pt: float = 0.0,
+    font_path: Optional[str] = None
+) -> Optional[int]:
+    """収まる最大のフォントサイズ（min_size でも収まらなければ None）"""
+    # 大半のスライドは縮小不要なので最大サイズを先に確認する
+    if fits(paragraphs, max_size, box_width_in, box_height_in, indent_pt, font_path):
+        return max_size
+    if not fits(paragraphs, min_size, box_width_in, box_height_in, indent_pt, font_path):
+        return None
+    low, high = min_size, max_size - 1
+    while low < high:
+        mid = (low + high + 1) // 2
+        if fits(paragraphs, mid, box_width_in, box_height_in, indent_pt, font_path):
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def split_to_fit(
+    paragraphs: List[str],
+    font_size: int,
+    box_width_in: float,
+    box_height_in: float,
+    indent_pt: float = 0.0,
+    font_path: Optional[str] = None
+) -> List[List[str]]:
+    """
+    段落リストをプレースホルダーに収まる単位に分割
+    1段落だけで収まらない場合はその段落単独で1チャンクとする
+    """
+    width_pt = box_width_in * 72 - MARGIN_X_PT
+    height_pt = box_height_in * 72 - MARGIN_Y_PT
+    chunks: List[List[str]] = []
+    current: List[str] = []
+    current_height = 0.0
+    for paragraph in paragraphs:
+        height = text_height([paragraph], font_size, width_pt, indent_pt, font_path)
+        if current and current_height + height > height_pt:
+            chunks.append(current)
+            current, current_height = [], 0.0
+        current.append(paragraph)
+        current_height += height
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def fit_paragraphs(
+    paragraphs: List[str],
+    box_width_in: float,
+    box_height_in: float,
+    max_size: int,
+    min_size: int = MIN_FONT_SIZE,
+    indent_pt: float = 0.0
+) -> Tuple[int, List[List[str]]]:
+    """
+    段落リストのフォントサイズと分割を決める
+    max_size で収まれば (max_size, [paragraphs])、縮小で収まれば (縮小サイズ, [paragraphs])、
+    min_size でも収まらなければ (min_size, 分割結果) を返す
+    """
+    font_path = resolve_font_path()
+    size = fit_font_size(paragraphs, box_width_in, box_height_in, max_size, min_size, indent_pt, font_path)
+    if size is not None:
+        return size, [paragraphs]
+    return min_size, split_to_fit(paragraphs, min_size, box_width_in, box_height_in, indent_pt, font_path)